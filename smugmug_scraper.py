@@ -4,42 +4,62 @@
 # @Last Modified by:   Evan Laske
 # @Last Modified time: 2017-04-21 22:50:29
 
-import urllib
-import json
+import urllib3
+import ijson
+import orjson
 import re
 import os
+import ssl
 import string
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+log = logging.getLogger(__name__)
+
+# Maximum number of simultaneous downloads (kept polite to SmugMug)
+_MAX_WORKERS = 16
+
+# Size of each chunk read from a download and written to disk
+_CHUNK_SIZE = 128 * 1024
+
+# Shared connection pool (and TLS context) for the whole run, so API calls and image
+# downloads across every album reuse keep-alive connections
+_HTTP = urllib3.PoolManager(maxsize=_MAX_WORKERS, block=False, ssl_context=ssl.create_default_context())
+
+# Generated with https://regex101.com/r/GFFZct/1
+_GALLERY_CONFIG_RE = re.compile(rb'galleryConfig\s*=\s*({.*?})\s*;', re.DOTALL)
+
+# Reserved characters in a folder/file name
+_FS_STRIP = str.maketrans('', '', r'/\*?:"<>')
 
 def get_gallery_config_from_html(html):
     """
     Finds the gallery configuration from the initial html page.
 
     Params:
-        html (str) - initial loaded HTML containing galleryConfig
+        html (bytes / str) - initial loaded HTML containing galleryConfig
 
     Returns: 
         dict of gallery configuration.
     """
     # trust but verify
-    if not type(html) is str:
-        raise TypeError("Type of html is not a string.")
-
-    # Generated with https://regex101.com/r/GFFZct/1
-    gallery_config = re.compile(r'.*?galleryConfig\s*=\s*({.*?})\s*;')
-
-    # Go through all the lines
-    for line in html.split('\n'):
-        # If there was a match
-        if "galleryConfig" in line:
-            json_text = gallery_config.search(line)
-            logging.debug("`{}` found in `{}`".format(json_text, line))
-            # Take the first matched group in the MatchObject
-            parsed = json.loads(json_text.group(1))
-            logging.info("Parsed JSON string with galleryConfig: \n{}".format(json.dumps(parsed, indent=4, sort_keys=True)))
-            return parsed
-
-    raise ValueError("HTML did not include any gallery configuration.")
+    if isinstance(html, str):
+        html = html.encode('utf-8')
+    elif not isinstance(html, bytes):
+        raise TypeError("Type of html is not bytes or a string.")
+
+    # Search the whole document at once
+    json_text = _GALLERY_CONFIG_RE.search(html)
+    if not json_text:
+        raise ValueError("HTML did not include any gallery configuration.")
+    log.debug("`%s` found in HTML", json_text)
+
+    # Take the first matched group in the MatchObject
+    parsed = orjson.loads(json_text.group(1))
+    if log.isEnabledFor(logging.INFO):
+        log.info("Parsed JSON string with galleryConfig: %s", orjson.dumps(parsed).decode())
+    return parsed
 
 
 def request_album_data(gallery_config):
@@ -57,14 +77,16 @@ def request_album_data(gallery_config):
     """
     url = build_request_url(gallery_config)
 
-    logging.info("Requesting Album Data from: {}".format(url))
+    log.info("Requesting Album Data from: %s", url)
 
     # Get the JSON data:
-    json_text = urllib.urlopen(url).read()
-    logging.debug("Received Album Data Response: {}".format(json_text))
+    json_text = _HTTP.request('GET', url).data
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Received Album Data Response: %s", json_text.decode('utf-8', 'replace'))
 
-    parsed = json.loads(json_text)
-    logging.info("Received Album Data: \n{}".format(json.dumps(parsed, indent=4, sort_keys=True)))
+    parsed = orjson.loads(json_text)
+    if log.isEnabledFor(logging.INFO):
+        log.info("Received Album Data: %s", orjson.dumps(parsed).decode())
 
     return parsed
 
@@ -72,23 +94,31 @@ def request_album_data(gallery_config):
 def build_request_url(gallery_config, size=0, sm_api_base="/services/api/json/1.4.0/", method='rpc.gallery.getalbum'):
     """
     Builds a URL to request data from the API
+
+    The URL up to PageSize is cached on gallery_config, so its
+    galleryRequestData must not change afterwards.
     """
     # verify that the parameters we need are in here
-    if not type(gallery_config) is dict:
+    if not isinstance(gallery_config, dict):
         raise TypeError("Type of gallery_config is not a dictionary.")
     if not ("breadcrumbs" in gallery_config and "galleryRequestData" in gallery_config):
         raise ValueError("gallery_config missing fields")
 
-    # Find the first non-blank url and use that to start
-    base_url = [x["url"] for x in gallery_config["breadcrumbs"] if x["url"]][0]
-    # Gather all the parameters
-    params = gallery_config["galleryRequestData"]
-    params["method"] = method           # Use this method
-    params["returnModelList"] = True    # Enable the PageSize variable
-    params["PageSize"] = size           # Make this lightweight - don't grab image info.
-    query_string = urllib.urlencode(params)
+    # The URL only differs in PageSize between requests, so cache everything before it
+    cache_key = f"_prefix:{sm_api_base}{method}"
+    prefix = gallery_config.get(cache_key)
+    if prefix is None:
+        # Find the first non-blank url and use that to start
+        base_url = next(x["url"] for x in gallery_config["breadcrumbs"] if x["url"])
+        # Gather all the parameters
+        params = dict(gallery_config["galleryRequestData"])
+        params["method"] = method           # Use this method
+        params["returnModelList"] = True    # Enable the PageSize variable
+        params.pop("PageSize", None)
+        prefix = base_url + sm_api_base + "?" + urlencode(params)
+        gallery_config[cache_key] = prefix
     # Generate the full URL
-    url = base_url + sm_api_base + "?" + query_string;
+    url = "{}&PageSize={}".format(prefix, size)
 
     return url
 
@@ -104,7 +134,7 @@ def request_image_data(gallery_config, album_data):
     Returns:
         images (list(dict)) - list of image data
     """
-    if not type(album_data) is dict:
+    if not isinstance(album_data, dict):
         raise TypeError("Type of album_data is not a dictionary.")
     if not ("Pagination" in album_data):
         raise ValueError("album_data missing fields")
@@ -112,16 +142,21 @@ def request_image_data(gallery_config, album_data):
     # Build the URL with the size of TotalItems
     url = build_request_url(gallery_config, size=album_data["Pagination"]["TotalItems"])
 
-    logging.info("Requesting All Image Data from: {}".format(url))
-
-    # Get the JSON data:
-    json_text = urllib.urlopen(url).read()
-    logging.debug("Received Image Data Response: {}".format(json_text))
+    log.info("Requesting All Image Data from: %s", url)
 
-    parsed = json.loads(json_text)
-    logging.info("Received Image Data for {} images.".format(len(parsed["Images"])))
+    # Parse the images incrementally as the JSON data arrives:
+    resp = _HTTP.request('GET', url, preload_content=False)
+    try:
+        images = list(ijson.items(resp, 'Images.item', use_float=True))
+    except BaseException:
+        # Don't hand a half-read connection back to the shared pool
+        resp.close()
+        raise
+    finally:
+        resp.release_conn()
+    log.info("Received Image Data for %d images.", len(images))
 
-    return parsed["Images"]
+    return images
 
 
 def get_image_url(image_data, sizes=None):
@@ -130,46 +165,60 @@ def get_image_url(image_data, sizes=None):
 
     Params:
         image_data (dict) - a single image data structure
-        sizes (list(str) / str) - None / Size / List of sizes
+        sizes (list(str) / tuple(str) / set(str) / str) - None / Size / Collection of sizes
 
     Returns:
         URL(s) in various form:
             size = None: URL as a generic string
     """
-    if not type(image_data) is dict:
-        raise TypeError("Type of image_data is not a dictionary.")
-    if not ("BaseUrl" in image_data and "ImageKey" in image_data and "URLFilename" in image_data):
-        raise ValueError("iamge_data missing fields")
+    urls = list(iter_image_urls([image_data], sizes))
+    # A single requested size must exist
+    if isinstance(sizes, str) and not urls:
+        raise ValueError("Size {} not in {}".format(sizes, image_data["Sizes"]))
+
+    return urls[0] if len(urls) == 1 else urls
+
+
+def iter_image_urls(images, sizes=None):
+    """
+    Generates the URLs of every image in the requested sizes.
 
-    # Generate a list of sizes from sizes
-    # If none, the list will be all of them:
+    Params:
+        images (list(dict)) - list of image data
+        sizes (list(str) / tuple(str) / set(str) / str) - None / Size / Collection of sizes
+
+    Yields:
+        url (str) - URL of one image in one size it is available in
+    """
+    # Validate the sizes once for all the images
+    # If none, each image will use all of its own:
     if not sizes:
-        sizes = image_data["Sizes"].keys()
-    # If there's one to use
-    elif type(sizes) is str:
-        if sizes in image_data["Sizes"]:
-            sizes = [sizes]
-        else:
-            raise ValueError("Size {} not in {}".format(sizes, image_data["Sizes"]))
-    elif type(sizes) is list:
-        sizes = [s for s in sizes if s in image_data["Sizes"]]
+        sizes = None
+    elif isinstance(sizes, str):
+        sizes = (sizes,)
+    elif isinstance(sizes, (list, tuple, set)):
+        # Drop duplicates but keep the requested order
+        sizes = tuple(dict.fromkeys(sizes))
     else:
         raise TypeError("size wasn't an expected type")
 
-    logging.info("Generating URLs for sizes {}".format(sizes))
-
-    # Generate all the URLs from the list of sizes:
-    urls = []
-    for s in sizes:
-        urls.append("{BaseUrl}i-{ImageKey}/1/{size}/{URLFilename}-{size}.{ext}".format(
-                            BaseUrl=image_data["BaseUrl"],
-                            ImageKey=image_data["ImageKey"],
-                            size=s,
-                            URLFilename=image_data["URLFilename"],
-                            ext=image_data["Sizes"][s]["ext"]
-                        )
-                    )
-    return urls[0] if len(urls) == 1 else urls
+    log.info("Generating URLs for sizes %s", sizes)
+
+    for image_data in images:
+        if not isinstance(image_data, dict):
+            raise TypeError("Type of image_data is not a dictionary.")
+        if not ("BaseUrl" in image_data and "ImageKey" in image_data and "URLFilename" in image_data):
+            raise ValueError("iamge_data missing fields")
+
+        # Look these up once rather than per size
+        base = image_data["BaseUrl"]
+        key = image_data["ImageKey"]
+        fn = image_data["URLFilename"]
+        exts = image_data["Sizes"]
+
+        for s in (exts if sizes is None else sizes):
+            if s in exts:
+                yield f"{base}i-{key}/1/{s}/{fn}-{s}.{exts[s]['ext']}"
 
 
 def get_valid_image_sizes(image_data):
@@ -192,22 +241,16 @@ def get_album_name(album_data):
     Params:
         album_data (dict) - album and pagination information
     """
-    if not type(album_data) is dict:
+    if not isinstance(album_data, dict):
         raise TypeError("Type of album_data is not a dictionary.")
 
-    # Get the title from the album
-    title = album_data["Albums"][0]["Title"]
-    print(title)
+    # Get the title from the album, stripping reserved characters
+    title = album_data["Albums"][0]["Title"].translate(_FS_STRIP)
 
-    # Reserved characters in a folder/file name... Python 2 sucks:
-    to_remove = r'[\/\*\?:"<>]+'
-    title = ''.join(re.split(to_remove, title))
-
-    print(title)
     return title
 
 
-def download_album(url, output_dir, sizes):
+def download_album(url, output_dir, sizes, pool=None):
     """
     Downloads all of the images in the given sizes from a url to a directory.
 
@@ -215,44 +258,101 @@ def download_album(url, output_dir, sizes):
         url (str) - url to download from
         output_dir (str) - directory to download album to
         sizes (list(str)) - list of sizes to download
+
+    Optional:
+        pool (Executor) - executor to download images on, shared between albums
     """
+    print("Processing {}".format(url))
     # Get the initial HTML from the URL
-    html = urllib.urlopen(url).read()
-    logging.debug("HTML: {}".format(html))
+    html = _HTTP.request('GET', url).data
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("HTML: %s", html.decode('utf-8', 'replace'))
     # Parse the HTML
     gallery_config = get_gallery_config_from_html(html)
     # Request album information
     album_data = request_album_data(gallery_config)
     # Get all the image info
     image_data = request_image_data(gallery_config, album_data)
-    print("Found {} images.".format(len(image_data)))
+    print("Found {} images in {}.".format(len(image_data), url))
 
     # Get the directory to save the file:
     output_dir = os.path.join(output_dir, get_album_name(album_data))
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    print("Outputting to {}".format(output_dir))
+    os.makedirs(output_dir, exist_ok=True)
+    print("Outputting {} to {}".format(url, output_dir))
+
+    # Download all of the images concurrently
+    if pool is None:
+        with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as pool:
+            try:
+                download_images(image_data, output_dir, sizes, pool)
+            except BaseException:
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+    else:
+        download_images(image_data, output_dir, sizes, pool)
 
-    # Download all of the images
-    for i in image_data:
-        # Get the image urls
-        image_urls = get_image_url(i, sizes)
-        if type(image_urls) is str:
-            download_file(image_urls, output_dir)
-        elif type(image_urls) is list:
-            for u in image_urls:
-                download_file(u, output_dir)
 
+def download_images(image_data, output_dir, sizes, pool):
+    """
+    Downloads the given sizes of each image on pool and waits for them all.
 
-def download_file(url, output_dir):
-    print("Downloading {}...".format(os.path.basename(url)))
-    urllib.urlretrieve(url, os.path.join(output_dir, os.path.basename(url)))
+    Params:
+        image_data (list(dict)) - list of image data
+        output_dir (str) - directory to download images to
+        sizes (list(str)) - list of sizes to download
+        pool (Executor) - executor to download images on
+    """
+    futures = [pool.submit(download_file, u, os.path.join(output_dir, os.path.basename(u)))
+               for u in iter_image_urls(image_data, sizes)]
+    try:
+        # Surface any download errors
+        for f in futures:
+            f.result()
+    except BaseException:
+        # Stop the queued downloads rather than waiting them out
+        for f in futures:
+            f.cancel()
+        raise
+
+
+def download_file(url, path):
+    print("Downloading {}...".format(path))
+    resp = _HTTP.request('GET', url, preload_content=False)
+    try:
+        with open(path, 'wb', buffering=0) as f:
+            # Stream to disk in bounded chunks rather than buffering the whole image.
+            # urllib3's readinto() copies out of read() internally, so a preallocated
+            # buffer would add a copy rather than save one; TLS rules out sendfile().
+            for chunk in resp.stream(_CHUNK_SIZE):
+                f.write(chunk)
+    except BaseException:
+        # Don't hand a half-read connection back to the shared pool
+        resp.close()
+        raise
+    finally:
+        resp.release_conn()
 
 
 def main(urls, output_dir, sizes):
-    for url in urls:
-        print("Processing {}".format(url))
-        download_album(url, output_dir, sizes)
+    if not urls:
+        return
+
+    # Albums are processed concurrently but share one download pool, so the
+    # total number of simultaneous downloads stays capped. Album threads are
+    # capped too so their API calls fit in the connection pool.
+    with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as pool, \
+         ThreadPoolExecutor(max_workers=min(len(urls), _MAX_WORKERS)) as albums:
+        futures = [albums.submit(download_album, url, output_dir, sizes, pool) for url in urls]
+        try:
+            # Surface any album errors
+            for f in futures:
+                f.result()
+        except BaseException:
+            # Stop the other albums and their queued downloads
+            for f in futures:
+                f.cancel()
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
 
 
 if __name__ == '__main__':